@@ -3,6 +3,8 @@
 
 import lxml.etree as etree
 import subprocess
+import hashlib
+import shutil
 import re
 import tempfile
 import math
@@ -86,6 +88,39 @@ class AffineTransform:
 		# TODO do a real matrix decomposition here!
 		return math.degrees(math.atan2(m21,m11))
 
+# timestamp used for PDF dates and IDs when SOURCE_DATE_EPOCH is not set,
+# so that converting the same SVG twice gives byte-identical output
+DEFAULT_SOURCE_DATE_EPOCH = '0'
+
+def deterministic_env():
+	env = dict(os.environ)
+	env.setdefault('SOURCE_DATE_EPOCH', DEFAULT_SOURCE_DATE_EPOCH)
+	return env
+
+def file_digest(path):
+	digest = hashlib.sha1()
+	with open(path, 'rb') as fl:
+		for chunk in iter(lambda: fl.read(1 << 16), b''):
+			digest.update(chunk)
+	return digest.digest()
+
+# moves srcpath to dstpath, unless dstpath already has the same content
+# (leaving its mtime alone, so make/latexmk don't see a change)
+def update_file(srcpath, dstpath):
+	if os.path.isfile(dstpath) and file_digest(srcpath) == file_digest(dstpath):
+		os.unlink(srcpath)
+		return False
+	shutil.move(srcpath, dstpath)
+	return True
+
+def write_text_if_changed(path, text, encoding='utf-8'):
+	data = text.encode(encoding)
+	if os.path.isfile(path) and file_digest(path) == hashlib.sha1(data).digest():
+		return False
+	with open(path, 'wb') as fl:
+		fl.write(data)
+	return True
+
 SVG_UNITS_TO_BIG_POINTS = 72.0/90.0
 
 PICTURE_PREAMBLE = r"""% Picture generated by svg2latex
@@ -113,13 +148,53 @@ STYLE_NORMAL = 0
 STYLE_ITALIC = 1
 STYLE_OBLIQUE = 2
 
+RAW_LABEL_PREFIX = '\\scalebox{' + str(SVG_UNITS_TO_BIG_POINTS) + '}{\\makebox(0,0)[bl]{%\n'
+
 class RawTeXLabel:
 	def __init__(s, pos, texcode):
 		s.pos = pos
 		s.code = texcode
 
 	def texcode(s):
-		return '\\scalebox{' + str(SVG_UNITS_TO_BIG_POINTS) + '}{\\makebox(0,0)[bl]{%\n' + s.code + '%\n}}'
+		return RAW_LABEL_PREFIX + s.code + '%\n}}'
+
+# font, color and alignment commands for a label style; there are usually
+# only a handful of distinct styles in a figure, so these are memoised
+LABEL_STYLE_PREFIXES = {}
+
+def label_style_prefix(fontfamily, bold, fontstyle, fontsize, color, align):
+	key = (fontfamily, bold, fontstyle, fontsize, color, align)
+	prefix = LABEL_STYLE_PREFIXES.get(key)
+	if prefix is None:
+		prefix = make_label_style_prefix(*key)
+		LABEL_STYLE_PREFIXES[key] = prefix
+	return prefix
+
+def make_label_style_prefix(fontfamily, bold, fontstyle, fontsize, color, align):
+	font, colorcode, aligncode = '', '', ''
+
+	r,g,b = color
+	if (r != 0) or (g != 0) or (b != 0):
+		colorcode = '\\color[RGB]{{{},{},{}}}'.format(r,g,b)
+
+	font = '\\' + fontfamily + 'family'
+	if bold:
+		font = font + r'\bfseries'
+	if fontstyle == STYLE_ITALIC:
+		font = font + r'\itshape'
+	elif fontstyle == STYLE_OBLIQUE:
+		font = font + r'\slshape'
+	if fontsize is not None:
+		font = font + fontsize
+
+	if align == ALIGN_LEFT:
+		aligncode = r'\makebox(0,0)[bl]'
+	elif align == ALIGN_CENTER:
+		aligncode = r'\makebox(0,0)[b]'
+	elif align == ALIGN_RIGHT:
+		aligncode = r'\makebox(0,0)[br]'
+
+	return font + colorcode + aligncode + r'{\smash{'
 
 class TeXLabel:
 	def __init__(s, pos, text):
@@ -135,36 +210,27 @@ class TeXLabel:
 		s.scale = 1.0
 
 	def texcode(s):
-		font, color, align = '', '', ''
-
-		r,g,b = s.color
-		if (r != 0) or (g != 0) or (b != 0):
-			color = '\\color[RGB]{{{},{},{}}}'.format(r,g,b)
-
-		font = '\\' + s.fontfamily + 'family'
-		if s.fontweight >= WEIGHT_BOLD:
-			font = font + r'\bfseries'
-		if s.fontstyle == STYLE_ITALIC:
-			font = font + r'\itshape'
-		elif s.fontstyle == STYLE_OBLIQUE:
-			font = font + r'\slshape'
-		if s.fontsize is not None:
-			font = font + s.fontsize
-
-		if s.align == ALIGN_LEFT:
-			align = r'\makebox(0,0)[bl]'
-		elif s.align == ALIGN_CENTER:
-			align = r'\makebox(0,0)[b]'
-		elif s.align == ALIGN_RIGHT:
-			align = r'\makebox(0,0)[br]'
-
-		texcode = font + color + align + r'{\smash{' + s.text + '}}'
+		prefix = label_style_prefix(s.fontfamily, s.fontweight >= WEIGHT_BOLD,
+				s.fontstyle, s.fontsize, tuple(s.color), s.align)
+		texcode = prefix + s.text + '}}'
 
 		if s.angle != 0.0:
 			texcode = '\\rotatebox{{{}}}{{{}}}'.format(s.angle, texcode)
 
 		return texcode
 
+RX_COORD_TRAILING_ZEROS = re.compile(r'(?<=\.\d)00$|(?<=\.\d\d)0$', re.MULTILINE)
+
+# formats numbers exactly as str(round(x,3)) would, but in a single
+# %-formatting pass; below 1e12 a double is precise enough that the
+# shortest repr of round(x,3) is the 3-decimal string minus trailing zeros
+def format_coordinates(values):
+	values = list(values)
+	if all(type(v) is float and -1e12 < v < 1e12 for v in values):
+		text = ('%.3f\n' * len(values)) % tuple(values)
+		return RX_COORD_TRAILING_ZEROS.sub('', text).split('\n')[:-1]
+	return [str(round(v,3)) for v in values]
+
 class TeXPicture:
 	def __init__(s, width, height):
 		s.width = width
@@ -173,16 +239,16 @@ class TeXPicture:
 		s.labels = []
 
 	def emit_picture(s, stream):
-		stream.write('\\begingroup%\n')
-		stream.write(PICTURE_PREAMBLE)
-		stream.write('\\begin{{picture}}({},{})%\n'.format(s.width, s.height))
+		parts = ['\\begingroup%\n', PICTURE_PREAMBLE,
+				'\\begin{{picture}}({},{})%\n'.format(s.width, s.height)]
 		if s.backgroundGraphic is not None:
-			stream.write('\\put(0,0){{\\includegraphics{{{}}}}}%\n'.format(s.backgroundGraphic))
-		for label in s.labels:
-			x,y = label.pos
-			stream.write('\\put({},{}){{{}}}%\n'.format(round(x,3),round(y,3), label.texcode()))
-		stream.write('\\end{picture}%\n')
-		stream.write('\\endgroup%\n')
+			parts.append('\\put(0,0){{\\includegraphics{{{}}}}}%\n'.format(s.backgroundGraphic))
+		xs = format_coordinates([label.pos[0] for label in s.labels])
+		ys = format_coordinates([label.pos[1] for label in s.labels])
+		parts.extend(map('\\put({},{}){{{}}}%\n'.format, xs, ys, [label.texcode() for label in s.labels]))
+		parts.append('\\end{picture}%\n')
+		parts.append('\\endgroup%\n')
+		stream.write(''.join(parts))
 
 	def add_label(s, label):
 		s.labels.append(label)
@@ -256,6 +322,105 @@ def compute_svg_transform(el):
 		el = el.getparent()
 	return xform
 
+# containers whose content is only ever drawn by reference, never in place
+SVG_UNRENDERED_CONTAINERS = {'defs', 'clipPath', 'mask', 'marker', 'pattern', 'symbol'}
+
+def get_svg_element_style(el):
+	st = {}
+	for prop in ('display', 'visibility', 'opacity'):
+		if prop in el.attrib:
+			st[prop] = el.attrib[prop].strip()
+	if 'style' in el.attrib:
+		st.update(split_svg_style(el.attrib['style']))
+	return st
+
+# Finds everything that wouldn't be drawn: subtrees with display:none or
+# opacity:0, and visibility:hidden elements (visibility is inherited, but
+# can be switched back on further down, so those only count when nothing
+# visible is left inside them).  Returns True if anything visible remains
+# below el.
+def find_invisible_svg(el, invisible, hidden=False):
+	any_visible = False
+	for child in el:
+		if not isinstance(child.tag, str) or not child.tag.startswith('{' + INKSVG_NAMESPACES['svg'] + '}'):
+			continue
+		if etree.QName(child).localname in SVG_UNRENDERED_CONTAINERS:
+			continue
+		st = get_svg_element_style(child)
+		try:
+			opacity = float(st.get('opacity', '1'))
+		except ValueError:
+			opacity = 1.0
+		if st.get('display') == 'none' or opacity <= 0.0:
+			invisible.append(child)
+			continue
+		visibility = st.get('visibility', 'inherit')
+		child_hidden = hidden if visibility == 'inherit' else visibility in ('hidden', 'collapse')
+		if find_invisible_svg(child, invisible, child_hidden) or not child_hidden:
+			any_visible = True
+		else:
+			invisible.append(child)
+	return any_visible
+
+RX_URL_REFERENCE = re.compile(r'''url\(\s*['"]?#([^)'"\s]+)''')
+XLINK_HREF = '{' + INKSVG_NAMESPACES['xlink'] + '}href'
+
+def find_svg_references(el):
+	ids = []
+	for name, value in el.attrib.items():
+		if name in (XLINK_HREF, 'href') and value.startswith('#'):
+			ids.append(value[1:])
+		else:
+			ids.extend(RX_URL_REFERENCE.findall(value))
+	return ids
+
+# Removes invisible content (see find_invisible_svg).  Invisible elements
+# that are still referenced from visible content (originals of clones kept
+# in a hidden layer, gradients, ...) are moved into <defs> instead, since
+# display and visibility don't carry over through a reference.
+def prune_invisible_svg(svgroot):
+	invisible = []
+	find_invisible_svg(svgroot, invisible)
+	if not invisible:
+		return
+
+	inside_invisible = set()
+	hidden_ids = {}
+	for el in invisible:
+		for d in el.iter():
+			inside_invisible.add(d)
+			if isinstance(d.tag, str) and 'id' in d.attrib:
+				hidden_ids[d.attrib['id']] = d
+
+	pending = []
+	for el in svgroot.iter():
+		if isinstance(el.tag, str) and el not in inside_invisible:
+			pending.extend(find_svg_references(el))
+	rescued = set()
+	while pending:
+		el = hidden_ids.get(pending.pop())
+		if el is not None and el not in rescued:
+			rescued.add(el)
+			for d in el.iter():
+				if isinstance(d.tag, str):
+					pending.extend(find_svg_references(d))
+
+	kept = set()
+	if rescued:
+		defs = svgroot.find('svg:defs', namespaces=INKSVG_NAMESPACES)
+		if defs is None:
+			defs = etree.Element('{' + INKSVG_NAMESPACES['svg'] + '}defs')
+			svgroot.insert(0, defs)
+		outermost = [el for el in svgroot.iter()
+				if el in rescued and not any(a in rescued for a in el.iterancestors())]
+		for el in outermost:
+			defs.append(el)
+			kept.update(el.iter())
+
+	for el in invisible:
+		if el not in kept and el.getparent() is not None:
+			el.getparent().remove(el)
+
 FONT_MAP = {
 	'CMU Serif': 'rm',
 	'CMU Sans Serif': 'sf',
@@ -350,6 +515,7 @@ def interpret_svg_textext(textEl, texDoc):
 
 def process_svg(inpath):
 	doc = etree.parse(inpath)
+	prune_invisible_svg(doc.getroot())
 	normalTextElements = doc.xpath('//svg:text', namespaces=INKSVG_NAMESPACES)
 	texTextElements = doc.xpath('//*[@textext:text]', namespaces=INKSVG_NAMESPACES)
 	# 72 big-points (PostScript points) per inch, 90 SVG "User Units" per inch
@@ -367,20 +533,25 @@ def process_svg(inpath):
 	return doc, texDoc
 
 def generate_pdf_from_svg(svgData, pdfpath):
+	tmppdf = pdfpath + '.tmp.pdf'
 	args = ['/usr/bin/inkscape',
 				'--without-gui',
 				'--export-area-page',
 				'--export-ignore-filters',
 				'--export-dpi=90',
-				'--export-pdf={}'.format(pdfpath)]
+				'--export-pdf={}'.format(tmppdf)]
 	with tempfile.NamedTemporaryFile(suffix='.svg', delete=True) as tmpsvg:
 		svgData.write(tmpsvg, encoding='utf-8', xml_declaration=True)
 		tmpsvg.flush()
 		args.append(tmpsvg.name)
-		with subprocess.Popen(args) as proc:
+		with subprocess.Popen(args, env=deterministic_env()) as proc:
 			proc.wait()
 			if proc.returncode != 0:
 				sys.stderr.write('inkscape svg->pdf failed')
+				if os.path.exists(tmppdf):
+					os.unlink(tmppdf)
+				return
+	update_file(tmppdf, pdfpath)
 
 def svgDataToPdfInkscape(xmldata, outpath):
 	fl = tempfile.NamedTemporaryFile(suffix='.svg',delete=True)
@@ -402,8 +573,9 @@ def main():
 
 	texDoc.backgroundGraphic = pdfpath
 
-	with open(texpath, 'w', encoding='utf-8') as fl:
-		texDoc.emit_picture(fl)
+	buf = io.StringIO()
+	texDoc.emit_picture(buf)
+	write_text_if_changed(texpath, buf.getvalue())
 	generate_pdf_from_svg(xmlData, pdfpath)
 
 if __name__ == '__main__':
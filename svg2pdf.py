@@ -6,10 +6,19 @@ import subprocess
 import tempfile
 import textwrap
 import argparse
+import hashlib
+import threading
+import concurrent.futures
+import binascii
+import fcntl
+import shlex
+import urllib.parse
 import string
 import codecs
 import shutil
 import math
+import stat
+import select
 import re
 import io
 import os
@@ -44,6 +53,35 @@ def ns_attrib(attrib):
 	ns, _, attrib = attrib.partition(':')
 	return '{' + SVG_NSS[ns] + '}' + attrib
 
+# timestamp used for PDF dates and IDs when SOURCE_DATE_EPOCH is not set,
+# so that converting the same SVG twice gives byte-identical output
+DEFAULT_SOURCE_DATE_EPOCH = '0'
+
+def deterministic_env():
+	env = dict(os.environ)
+	env.setdefault('SOURCE_DATE_EPOCH', DEFAULT_SOURCE_DATE_EPOCH)
+	return env
+
+def file_digest(path):
+	digest = hashlib.sha1()
+	with open(path, 'rb') as fl:
+		for chunk in iter(lambda: fl.read(1 << 16), b''):
+			digest.update(chunk)
+	return digest.digest()
+
+# puts srcpath at dstpath, unless dstpath already has the same content
+# (leaving its mtime alone, so make/latexmk don't see a change)
+def update_file(srcpath, dstpath, keep_src=False):
+	if os.path.isfile(dstpath) and file_digest(srcpath) == file_digest(dstpath):
+		if not keep_src:
+			os.unlink(srcpath)
+		return False
+	if keep_src:
+		shutil.copy(srcpath, dstpath)
+	else:
+		shutil.move(srcpath, dstpath)
+	return True
+
 class WorkingDirectory:
 	def __init__(self, new_dir):
 		self._new_dir = new_dir
@@ -57,6 +95,109 @@ class WorkingDirectory:
 	def __exit__(self, exc_type, exc_value, traceback):
 		os.chdir(self._cwd)
 
+RX_JOBSERVER_AUTH = re.compile(r'--jobserver-(?:auth|fds)=(\S+)')
+
+# strips pipe-style jobserver arguments from MAKEFLAGS, for processes
+# that don't actually share file descriptors with make
+def strip_jobserver_fds(makeflags):
+	return RX_JOBSERVER_AUTH.sub(
+			lambda m: m.group(0) if m.group(1).startswith('fifo:') else '', makeflags)
+
+class JobServer:
+	# Limits how many subprocesses run at once.  When run from a parallel
+	# GNU make, tokens are taken from make's jobserver (on top of the one
+	# token every job implicitly holds); otherwise max_jobs applies.
+	def __init__(self, max_jobs=None):
+		self._lock = threading.Lock()
+		self._implicit_free = True
+		self._rfd = None
+		self._wfd = None
+		self._owns_fds = False
+		if not self._connect(os.environ.get('MAKEFLAGS', '')):
+			if max_jobs is None:
+				max_jobs = 1
+		self.max_jobs = max_jobs
+		self._limit = threading.Semaphore(max_jobs) if max_jobs is not None else None
+
+	@property
+	def from_make(self):
+		return self._rfd is not None
+
+	def _connect(self, makeflags):
+		auths = RX_JOBSERVER_AUTH.findall(makeflags)
+		if not auths:
+			return False
+		auth = auths[-1]
+		try:
+			if auth.startswith('fifo:'):
+				fd = os.open(auth[len('fifo:'):], os.O_RDWR)
+				self._rfd = self._wfd = fd
+				self._owns_fds = True
+			else:
+				rfd, wfd = [int(x) for x in auth.split(',')]
+				# make only passes the pipe on to recipes marked with '+'
+				if rfd < 0 or wfd < 0:
+					return False
+				if not (stat.S_ISFIFO(os.fstat(rfd).st_mode) and stat.S_ISFIFO(os.fstat(wfd).st_mode)):
+					return False
+				self._rfd, self._wfd = rfd, wfd
+		except (OSError, ValueError):
+			print('jobserver unavailable, ignoring MAKEFLAGS', file=sys.stderr)
+			self._rfd = self._wfd = None
+			return False
+		return True
+
+	def acquire(self):
+		if self._limit is not None:
+			self._limit.acquire()
+		if self._rfd is None:
+			return None
+		with self._lock:
+			if self._implicit_free:
+				self._implicit_free = False
+				return None
+		while True:
+			try:
+				return os.read(self._rfd, 1)
+			except InterruptedError:
+				continue
+			except BlockingIOError:
+				# some makes leave the (shared) pipe non-blocking; wait for a token
+				select.select([self._rfd], [], [])
+
+	def release(self, token):
+		if self._rfd is not None:
+			if token is None:
+				with self._lock:
+					self._implicit_free = True
+			else:
+				os.write(self._wfd, token)
+		if self._limit is not None:
+			self._limit.release()
+
+	def run(self, fn, *args):
+		token = self.acquire()
+		try:
+			return fn(*args)
+		finally:
+			self.release(token)
+
+	def map(self, fn, items):
+		items = list(items)
+		if not items:
+			return []
+		# under make, the jobserver decides how many actually run; the pool
+		# only needs enough threads to use the tokens it can plausibly get
+		workers = self.max_jobs or (os.cpu_count() or 1)
+		with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(items))) as pool:
+			futures = [pool.submit(self.run, fn, item) for item in items]
+			return [f.result() for f in futures]
+
+	def close(self):
+		if self._owns_fds:
+			os.close(self._rfd)
+		self._rfd = self._wfd = None
+
 class AffineTransform:
 	def __init__(s, t=None, m=None):
 		s.t = (0.0, 0.0) if t is None else t
@@ -188,6 +329,105 @@ def svg_find_accumulated_transform(el):
 		el = el.getparent()
 	return xform
 
+# containers whose content is only ever drawn by reference, never in place
+SVG_UNRENDERED_CONTAINERS = {'defs', 'clipPath', 'mask', 'marker', 'pattern', 'symbol'}
+
+def svg_element_style(el):
+	st = {}
+	for prop in ('display', 'visibility', 'opacity'):
+		if prop in el.attrib:
+			st[prop] = el.attrib[prop].strip()
+	if 'style' in el.attrib:
+		st.update(svg_split_style(el.attrib['style']))
+	return st
+
+# Finds everything that wouldn't be drawn: subtrees with display:none or
+# opacity:0, and visibility:hidden elements (visibility is inherited, but
+# can be switched back on further down, so those only count when nothing
+# visible is left inside them).  Returns True if anything visible remains
+# below el.
+def svg_find_invisible(el, invisible, hidden=False):
+	any_visible = False
+	for child in el:
+		if not isinstance(child.tag, str) or not child.tag.startswith('{' + SVG_NSS['svg'] + '}'):
+			continue
+		if etree.QName(child).localname in SVG_UNRENDERED_CONTAINERS:
+			continue
+		st = svg_element_style(child)
+		try:
+			opacity = float(st.get('opacity', '1'))
+		except ValueError:
+			opacity = 1.0
+		if st.get('display') == 'none' or opacity <= 0.0:
+			invisible.append(child)
+			continue
+		visibility = st.get('visibility', 'inherit')
+		child_hidden = hidden if visibility == 'inherit' else visibility in ('hidden', 'collapse')
+		if svg_find_invisible(child, invisible, child_hidden) or not child_hidden:
+			any_visible = True
+		else:
+			invisible.append(child)
+	return any_visible
+
+RX_URL_REFERENCE = re.compile(r'''url\(\s*['"]?#([^)'"\s]+)''')
+XLINK_HREF = '{' + SVG_NSS['xlink'] + '}href'
+
+def svg_find_references(el):
+	ids = []
+	for name, value in el.attrib.items():
+		if name in (XLINK_HREF, 'href') and value.startswith('#'):
+			ids.append(value[1:])
+		else:
+			ids.extend(RX_URL_REFERENCE.findall(value))
+	return ids
+
+# Removes invisible content (see svg_find_invisible).  Invisible elements
+# that are still referenced from visible content (originals of clones kept
+# in a hidden layer, gradients, ...) are moved into <defs> instead, since
+# display and visibility don't carry over through a reference.
+def svg_prune_invisible(svgroot):
+	invisible = []
+	svg_find_invisible(svgroot, invisible)
+	if not invisible:
+		return
+
+	inside_invisible = set()
+	hidden_ids = {}
+	for el in invisible:
+		for d in el.iter():
+			inside_invisible.add(d)
+			if isinstance(d.tag, str) and 'id' in d.attrib:
+				hidden_ids[d.attrib['id']] = d
+
+	pending = []
+	for el in svgroot.iter():
+		if isinstance(el.tag, str) and el not in inside_invisible:
+			pending.extend(svg_find_references(el))
+	rescued = set()
+	while pending:
+		el = hidden_ids.get(pending.pop())
+		if el is not None and el not in rescued:
+			rescued.add(el)
+			for d in el.iter():
+				if isinstance(d.tag, str):
+					pending.extend(svg_find_references(d))
+
+	kept = set()
+	if rescued:
+		defs = svgroot.find('svg:defs', namespaces=SVG_NSS)
+		if defs is None:
+			defs = etree.Element('{' + SVG_NSS['svg'] + '}defs')
+			svgroot.insert(0, defs)
+		outermost = [el for el in svgroot.iter()
+				if el in rescued and not any(a in rescued for a in el.iterancestors())]
+		for el in outermost:
+			defs.append(el)
+			kept.update(el.iter())
+
+	for el in invisible:
+		if el not in kept and el.getparent() is not None:
+			el.getparent().remove(el)
+
 RX_LENGTH = re.compile(r'''
     \s*
 	    (?P<value>
@@ -215,8 +455,28 @@ def get_lines_from_tspans(textnode):
 		lines.append(el.text)
 	return lines
 
+RX_COORD_TRAILING_ZEROS = re.compile(r'(?<=\.\d)00$|(?<=\.\d\d)0$', re.MULTILINE)
+
+# formats numbers exactly as str(round(x,3)) would, but in a single
+# %-formatting pass; below 1e12 a double is precise enough that the
+# shortest repr of round(x,3) is the 3-decimal string minus trailing zeros
+def format_coordinates(values):
+	values = list(values)
+	if all(type(v) is float and -1e12 < v < 1e12 for v in values):
+		text = ('%.3f\n' * len(values)) % tuple(values)
+		return RX_COORD_TRAILING_ZEROS.sub('', text).split('\n')[:-1]
+	return [str(round(v,3)) for v in values]
+
+# pdfTeX derives the trailer /ID from the time and the absolute output path
+# (which is in a fresh temporary directory on every run), and copies the
+# info dictionary of included PDFs; drop both so unchanged figures come out
+# byte-identical.  SOURCE_DATE_EPOCH (see deterministic_env) pins the dates.
+TEX_DETERMINISTIC_PDF = r'''\ifdefined\pdftrailerid\pdftrailerid{}\fi
+\ifdefined\pdfsuppressptexinfo\pdfsuppressptexinfo=-1\fi
+'''
+
 TEX_WRAPPER_HEAD = string.Template(r'''\documentclass{standalone}
-\usepackage{varwidth}
+$deterministic_pdf\usepackage{varwidth}
 \usepackage{graphicx}
 \usepackage{color}
 \usepackage{rotating}
@@ -226,7 +486,7 @@ $extra_preamble
 \begingroup%
 \begin{picture}($picture_width,$picture_height)%
 ''')
-TEX_WRAPPER_NODE = string.Template(r'\put($x,$y){$texcode}')
+TEX_WRAPPER_NODE = '\\put({},{}){{{}}}%\n'.format
 TEX_WRAPPER_TAIL = string.Template(r'''\end{picture}%
 \endgroup%
 \end{document}
@@ -240,23 +500,100 @@ class TeXPicture:
 		self.extra_preamble = ''
 
 	def emit_standalone(self, out):
-		out.write(TEX_WRAPPER_HEAD.substitute(
+		parts = [TEX_WRAPPER_HEAD.substitute(
+			deterministic_pdf=TEX_DETERMINISTIC_PDF,
 			extra_preamble=self.extra_preamble,
 			picture_width=self.width,
-			picture_height=self.height))
-		for node in self.nodes:
-			out.write(node.to_tex())
-			out.write('%\n')
-		out.write(TEX_WRAPPER_TAIL.substitute())
+			picture_height=self.height)]
+		parts.extend(self.format_nodes())
+		parts.append(TEX_WRAPPER_TAIL.substitute())
+		out.write(''.join(parts))
+
+	def format_nodes(self):
+		xs = format_coordinates([node.tex_pos[0] for node in self.nodes])
+		ys = format_coordinates([node.tex_pos[1] for node in self.nodes])
+		return map(TEX_WRAPPER_NODE, xs, ys, [node.texcode for node in self.nodes])
 
 class TeXPictureElement:
 	def __init__(self):
 		self.tex_pos = (0.0, 0.0)
 		self.texcode = ''
+		self.is_label = False
 
-	def to_tex(self):
-		return TEX_WRAPPER_NODE.substitute(
-				x=round(self.tex_pos[0],3), y=round(self.tex_pos[1],3), texcode=self.texcode)
+# Each label is typeset on its own into a square page, with the label's
+# reference point at the centre, so that the snippet can later be placed
+# by centring it on the label position.  LABEL_SNIPPET_SIZE (in picture
+# units) must comfortably exceed twice the extent of any label.
+LABEL_SNIPPET_SIZE = 3600
+LABEL_SNIPPET = string.Template(r'''\documentclass[border=0pt]{standalone}
+$deterministic_pdf\usepackage{varwidth}
+\usepackage{graphicx}
+\usepackage{color}
+\usepackage{rotating}
+$extra_preamble
+\begin{document}%
+\setlength{\unitlength}{0.8bp}%
+\begin{picture}($size,$size)%
+\put($half,$half){$texcode}%
+\end{picture}%
+\end{document}
+''')
+
+def default_label_cache_dir():
+	cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+	return os.path.join(cache_home, 'svg2pdf', 'labels')
+
+# Replaces the label nodes of each picture by pre-typeset PDF snippets,
+# typesetting (in the current directory) only the labels that aren't in
+# cache_dir yet.  Snippets are keyed on the full snippet source, so the
+# preamble is part of the key.  The returned pictures need no preamble.
+def composite_cached_labels(texpics, cache_dir, jobs, command='pdflatex'):
+	os.makedirs(cache_dir, exist_ok=True)
+	pending = {}
+	used = set()
+	composites = []
+	for texpic in texpics:
+		composite = TeXPicture()
+		composite.width = texpic.width
+		composite.height = texpic.height
+		for node in texpic.nodes:
+			if not node.is_label:
+				composite.nodes.append(node)
+				continue
+			source = LABEL_SNIPPET.substitute(
+					deterministic_pdf=TEX_DETERMINISTIC_PDF,
+					extra_preamble=texpic.extra_preamble,
+					size=LABEL_SNIPPET_SIZE,
+					half=LABEL_SNIPPET_SIZE // 2,
+					texcode=node.texcode)
+			key = hashlib.sha1((command + '\n' + source).encode('utf-8')).hexdigest()
+			if key not in used and not os.path.isfile(os.path.join(cache_dir, key + '.pdf')):
+				pending[key] = source
+			used.add(key)
+			placed = TeXPictureElement()
+			placed.tex_pos = node.tex_pos
+			placed.texcode = '\\makebox(0,0){{\\includegraphics{{label-{}.pdf}}}}'.format(key)
+			composite.nodes.append(placed)
+		composites.append(composite)
+
+	def typeset(key):
+		texname = 'label-{}.tex'.format(key)
+		with open(texname, mode='w', encoding='utf-8') as texfile:
+			texfile.write(pending[key])
+		execute_latex(texname, command)
+		with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.part', delete=False) as tmpfile:
+			with open('label-{}.pdf'.format(key), 'rb') as pdffile:
+				shutil.copyfileobj(pdffile, tmpfile)
+		os.replace(tmpfile.name, os.path.join(cache_dir, key + '.pdf'))
+
+	print('labels: {} distinct, {} to typeset'.format(len(used), len(pending)))
+	jobs.map(typeset, sorted(pending))
+	for key in sorted(used - set(pending)):
+		snippet = 'label-{}.pdf'.format(key)
+		if os.path.lexists(snippet):
+			os.unlink(snippet)
+		os.symlink(os.path.join(cache_dir, key + '.pdf'), snippet)
+	return composites
 
 def convert_tspans_to_tex(text_node):
 	# TODO make this much more comprehensive in understanding SVG text and styling
@@ -269,9 +606,97 @@ def convert_tspans_to_tex(text_node):
 def decode_escaped_string(text, encoding='utf-8'):
 	return codecs.escape_decode(text)[0].decode(encoding)
 
-def extract_images_to_texpic(svgroot, pic, svg_dir):
+RX_DATA_URI = re.compile(r'^\s*data:(?P<mime>[^;,]*)(?P<params>(?:;[^;,]*)*),')
+RX_BASE64_JUNK = re.compile(r'[^A-Za-z0-9+/=]')
+
+# image formats that pdflatex can \includegraphics; anything else is left
+# in the SVG for Inkscape to render into the background
+IMAGE_MIME_EXTENSIONS = {
+	'image/png': '.png',
+	'image/jpeg': '.jpg',
+	'image/jpg': '.jpg',
+	'application/pdf': '.pdf',
+}
+LATEX_IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.pdf'}
+
+DATA_URI_CHUNK_SIZE = 1 << 20
+
+def data_uri_mime(uri):
+	m = RX_DATA_URI.match(uri)
+	return m.group('mime').strip().lower() or 'text/plain'
+
+# decodes a data: URI into outfile a chunk at a time, returning (mime type, sha1 hexdigest)
+def decode_data_uri_to_file(uri, outfile, chunk_size=DATA_URI_CHUNK_SIZE):
+	m = RX_DATA_URI.match(uri)
+	if m is None:
+		raise Exception('invalid data URI')
+	mime = data_uri_mime(uri)
+	is_base64 = 'base64' in [x.strip().lower() for x in m.group('params').split(';')]
+	digest = hashlib.sha1()
+	pending = ''
+	start = m.end()
+	# base64 works in 4-character quanta; anything left over is carried into the next chunk
+	chunk_size = max(4, chunk_size - chunk_size % 4)
+	for offset in range(start, len(uri), chunk_size):
+		piece = uri[offset:offset+chunk_size]
+		if is_base64:
+			piece = pending + RX_BASE64_JUNK.sub('', piece)
+			usable = len(piece) - len(piece) % 4
+			pending = piece[usable:]
+			data = binascii.a2b_base64(piece[:usable])
+		else:
+			# don't split a %XX escape across chunks
+			cut = piece.rfind('%', max(0, len(piece) - 2))
+			if cut != -1:
+				piece, carry = pending + piece[:cut], piece[cut:]
+			else:
+				piece, carry = pending + piece, ''
+			pending = carry
+			data = urllib.parse.unquote_to_bytes(piece)
+		digest.update(data)
+		outfile.write(data)
+	if pending:
+		if is_base64:
+			raise Exception('truncated base64 data in data URI')
+		data = urllib.parse.unquote_to_bytes(pending)
+		digest.update(data)
+		outfile.write(data)
+	return mime, digest.hexdigest()
+
+# embedded images are staged in the current directory, named by content hash
+# so that identical payloads are only written once
+def stage_data_uri_image(uri):
+	with tempfile.NamedTemporaryFile(dir='.', prefix='image-', suffix='.part', delete=False) as stagefile:
+		try:
+			mime, digest = decode_data_uri_to_file(uri, stagefile)
+		except:
+			stagefile.close()
+			os.unlink(stagefile.name)
+			raise
+	localpath = 'image-{}{}'.format(digest, IMAGE_MIME_EXTENSIONS[mime])
+	if os.path.exists(localpath):
+		# identical payload already staged
+		os.unlink(stagefile.name)
+	else:
+		os.replace(stagefile.name, localpath)
+	return localpath
+
+def extract_images_to_texpic(svgroot, pic, svg_dir, image_prefix='image'):
 	image_id = 1
-	for el in svgroot.xpath('//svg:image', namespaces=SVG_NSS):
+	for el in svgroot.xpath('.//svg:image', namespaces=SVG_NSS):
+		path = el.attrib.get(ns_attrib('xlink:href'), el.attrib.get('href'))
+		if not path:
+			raise Exception('image without href (id "{}")'.format(el.attrib.get('id', '')))
+		is_data = RX_DATA_URI.match(path) is not None
+		if is_data:
+			image_ok = data_uri_mime(path) in IMAGE_MIME_EXTENSIONS
+		else:
+			image_ok = os.path.splitext(path)[1].lower() in LATEX_IMAGE_EXTENSIONS
+		if not image_ok:
+			print('leaving image for inkscape (format not supported by LaTeX):',
+					el.attrib.get('id', path[:40]))
+			continue
+
 		node = TeXPictureElement()
 
 		width = svg_parse_length(el.attrib['width'])
@@ -283,11 +708,14 @@ def extract_images_to_texpic(svgroot, pic, svg_dir):
 		node.svg_pos = (x,y)
 		x,y = node.xform.applyTo(x,y)
 
-		path = el.attrib[ns_attrib('xlink:href')]
-		_, image_ext = os.path.splitext(path)
-		fullpath = os.path.join(svg_dir, path)
-		localpath = 'image{}{}'.format(image_id, image_ext)
-		shutil.copy(fullpath, localpath)
+		if is_data:
+			localpath = stage_data_uri_image(path)
+		else:
+			_, image_ext = os.path.splitext(path)
+			fullpath = os.path.join(svg_dir, path)
+			localpath = '{}{}{}'.format(image_prefix, image_id, image_ext)
+			image_id += 1
+			shutil.copy(fullpath, localpath)
 
 		node.tex_pos = (x, pic.height - y - height)
 		node.texcode = '\\includegraphics[width={}in,height={}in]{{{}}}'.format(
@@ -303,7 +731,7 @@ def extract_text_to_texpic(svgroot, pic):
 	wrapper.subsequent_indent = '   '
 
 	# attempt to convert normal SVG text
-	for el in svgroot.xpath('//svg:text', namespaces=SVG_NSS):
+	for el in svgroot.xpath('.//svg:text', namespaces=SVG_NSS):
 		node = TeXPictureElement()
 		node.xform = svg_find_accumulated_transform(el)
 		x = svg_parse_length(el.attrib.get('x','0'))
@@ -316,14 +744,16 @@ def extract_text_to_texpic(svgroot, pic):
 		#pic.nodes.append(node)
 		el.getparent().remove(el)
 
-	preamble_files = set()
+	# ordered, so the preamble comes out the same on every run
+	preamble_files = []
 
 	# extract textext nodes
-	for el in svgroot.xpath('//*[@textext:text]', namespaces=SVG_NSS):
+	for el in svgroot.xpath('.//*[@textext:text]', namespaces=SVG_NSS):
 		node = TeXPictureElement()
 		textext = decode_escaped_string(el.attrib[ns_attrib('textext:text')])
 		preamble_src = decode_escaped_string(el.attrib[ns_attrib('textext:preamble')])
-		preamble_files.add(preamble_src)
+		if preamble_src not in preamble_files:
+			preamble_files.append(preamble_src)
 		node.texcode = (
 				'\\makebox(0,0)[lt]{\\begin{varwidth}{20in}%\n' +
 				textext +
@@ -332,12 +762,13 @@ def extract_text_to_texpic(svgroot, pic):
 		node.svg_pos = (0,0)
 		x,y = node.xform.t
 		node.tex_pos = (x, pic.height - y)
+		node.is_label = True
 		pic.nodes.append(node)
 		el.getparent().remove(el)
 
 	preamble = []
 	for path in preamble_files:
-		print('preamble from:', preamble_src)
+		print('preamble from:', path)
 		with open(path, 'r', encoding='utf-8') as fl:
 			preamble.extend(fl.readlines())
 
@@ -345,44 +776,203 @@ def extract_text_to_texpic(svgroot, pic):
 	print('extra premable:')
 	print(pic.extra_preamble)
 
-def convert_svg_to_texpic(svgroot, svg_dir):
+def convert_svg_to_texpic(svgroot, svg_dir, scope=None, background='graphic_only.pdf', image_prefix='image'):
 	texpic = TeXPicture()
 	texpic.width = svg_parse_length(svgroot.attrib['width'])
 	texpic.height = svg_parse_length(svgroot.attrib['height'])
 
+	# only extract from the given subtree (e.g., a single layer)
+	if scope is None:
+		scope = svgroot
+		svg_prune_invisible(svgroot)
+
 	# we totally ignore the correct layering of the SVG document,
 	# and just enforce a split of three layers that are sensible in "most" cases
 
 	# first we have any embedded images
-	extract_images_to_texpic(svgroot, texpic, svg_dir)
+	extract_images_to_texpic(scope, texpic, svg_dir, image_prefix=image_prefix)
 
 	# then we have the SVG elements (lines, rects, paths, etc)
 	bgnode = TeXPictureElement()
 	bgnode.xform = AffineTransform()
 	bgnode.tex_pos = (0.0, 0.0)
-	bgnode.texcode = '\\put(0,0){{\\includegraphics{{{}}}}}'.format('graphic_only.pdf')
+	bgnode.texcode = '\\put(0,0){{\\includegraphics{{{}}}}}'.format(background)
 	texpic.nodes.append(bgnode)
 
 	# then we have any text (labels)
-	extract_text_to_texpic(svgroot, texpic)
+	extract_text_to_texpic(scope, texpic)
 	return texpic
 
+def svg_find_layers(svgroot):
+	return svgroot.xpath('./svg:g[@inkscape:groupmode="layer"]', namespaces=SVG_NSS)
+
+# children of the root element that aren't drawn themselves
+SVG_NON_CONTENT = SVG_UNRENDERED_CONTAINERS | {'metadata', 'title', 'desc', 'style', 'script'}
+
+# rendered elements outside any top-level layer, which a per-layer export loses
+def svg_find_unlayered_content(svgroot):
+	layers = set(svg_find_layers(svgroot))
+	return [el for el in svgroot
+			if isinstance(el.tag, str) and el.tag.startswith('{' + SVG_NSS['svg'] + '}')
+			and etree.QName(el).localname not in SVG_NON_CONTENT
+			and el not in layers]
+
+# Layers are numbered in document order, counting hidden layers too, so
+# that hiding a layer doesn't renumber the ones after it.  Returns the
+# (number, id, background pdf, picture) of each visible layer, and the
+# numbers of the hidden ones.
+def convert_svg_layers_to_texpics(svgroot, svg_dir):
+	all_layers = svg_find_layers(svgroot)
+	svg_prune_invisible(svgroot)
+	hidden = []
+	unlayered = svg_find_unlayered_content(svgroot)
+	if unlayered:
+		print('warning: {} element(s) outside any layer are left out of the layer outputs: {}'.format(
+				len(unlayered), ', '.join(el.attrib.get('id', etree.QName(el).localname) for el in unlayered)),
+				file=sys.stderr)
+	layers = []
+	for i, layer in enumerate(all_layers, 1):
+		if layer.getparent() is not svgroot:
+			hidden.append(i)
+			continue
+		if 'id' not in layer.attrib:
+			layer.attrib['id'] = 'svg2pdf-layer{}'.format(i)
+		background = 'layer{}_graphic.pdf'.format(i)
+		texpic = convert_svg_to_texpic(svgroot, svg_dir, scope=layer,
+				background=background, image_prefix='layer{}-image'.format(i))
+		layers.append((i, layer.attrib['id'], background, texpic))
+	return layers, hidden
+
+# inkscape --shell reads each line like a command line (quotes and all)
+def inkscape_shell_line(args):
+	return ' '.join(shlex.quote(arg) for arg in args)
+
+class InkscapeShell:
+	# A resident `inkscape --shell` process, so that conversions don't pay
+	# for Inkscape's start-up.  It may be shared by forked processes: each
+	# command takes an flock on a lock file (opened per call, so that the
+	# lock is per process), and a crashed holder releases it automatically.
+	def __init__(self):
+		self._proc = None
+		fd, self._lockpath = tempfile.mkstemp(prefix='svg2pdf-inkscape', suffix='.lock')
+		os.close(fd)
+
+	def start(self):
+		self._proc = subprocess.Popen(['/usr/bin/inkscape', '--without-gui', '--shell'],
+				stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=deterministic_env())
+		self._read_to_prompt()
+
+	def alive(self):
+		# only meaningful in the process that started the shell
+		return self._proc is not None and self._proc.poll() is None
+
+	def _read_to_prompt(self):
+		buf = b''
+		while not buf.rstrip().endswith(b'>'):
+			data = os.read(self._proc.stdout.fileno(), 65536)
+			if not data:
+				raise Exception('inkscape shell exited unexpectedly')
+			buf += data
+		return buf.rstrip()[:-1].decode('utf-8', 'replace')
+
+	def run(self, args):
+		line = inkscape_shell_line(args)
+		with open(self._lockpath, 'w') as lockfile:
+			fcntl.flock(lockfile, fcntl.LOCK_EX)
+			print('inkscape shell:', line)
+			self._proc.stdin.write(line.encode('utf-8') + b'\n')
+			self._proc.stdin.flush()
+			output = self._read_to_prompt()
+		if output.strip():
+			print(output.strip())
+
+	def close(self):
+		if self._proc is not None:
+			self._proc.stdin.close()
+			self._proc.wait()
+			self._proc = None
+		os.unlink(self._lockpath)
+
+# when set, exports go through this resident shell instead of a new Inkscape
+INKSCAPE_SHELL = None
+
+# the shell doesn't report failures, so check the output actually appeared
+def run_inkscape_shell_export(args, pdfpath):
+	if os.path.exists(pdfpath):
+		os.unlink(pdfpath)
+	INKSCAPE_SHELL.run(args)
+	if not os.path.exists(pdfpath):
+		raise Exception('inkscape failed to export ' + pdfpath)
+
+# a resident Inkscape doesn't run in svg_dir, so relative image links
+# left in the document are made absolute
+def svg_absolutize_image_hrefs(svgroot, svg_dir):
+	for el in svgroot.xpath('.//svg:image', namespaces=SVG_NSS):
+		for attrib in (ns_attrib('xlink:href'), 'href'):
+			path = el.attrib.get(attrib)
+			if path and not RX_DATA_URI.match(path) and ':' not in path.partition('/')[0]:
+				el.attrib[attrib] = os.path.join(svg_dir, path)
+
 def generate_pdf_from_svg(svgdata, svgname, pdfname, svg_dir=None):
 	svgpath = os.path.abspath(svgname)
 	pdfpath = os.path.abspath(pdfname)
-	cmd = ['/usr/bin/inkscape',
-	       '--without-gui',
+	export_args = [
 	       '--export-area-page',
 	       '--export-pdf={}'.format(pdfpath),
 	       svgpath]
+	cmd = ['/usr/bin/inkscape', '--without-gui'] + export_args
+	if svg_dir is None:
+		svg_dir = os.getcwd()
+	if INKSCAPE_SHELL is not None:
+		svg_absolutize_image_hrefs(svgdata.getroot(), svg_dir)
 	with open(svgpath, 'wb') as svgfile:
 		svgdata.write(svgfile, encoding='utf-8', xml_declaration=True)
+	if INKSCAPE_SHELL is not None:
+		run_inkscape_shell_export(export_args, pdfpath)
+		return
+	with WorkingDirectory(svg_dir):
+		print('cwd for inkscape:', os.getcwd())
+		print('inkscape command:', ' '.join(cmd))
+		subprocess.check_call(cmd, stdin=subprocess.DEVNULL, env=deterministic_env())
+
+# exports several objects (by id) from one SVG, each to its own PDF, with a
+# single Inkscape process driven through its --shell interface
+def generate_pdfs_from_svg_ids(svgdata, svgname, exports, svg_dir=None):
+	svgpath = os.path.abspath(svgname)
+	cmd = ['/usr/bin/inkscape', '--without-gui', '--shell']
+	export_args = []
+	for object_id, pdfname in exports:
+		export_args.append([
+			svgpath,
+			'--export-area-page',
+			'--export-id={}'.format(object_id),
+			'--export-id-only',
+			'--export-pdf={}'.format(os.path.abspath(pdfname))])
+	commands = [inkscape_shell_line(args) for args in export_args]
+	commands.append('quit')
 	if svg_dir is None:
 		svg_dir = os.getcwd()
+	if INKSCAPE_SHELL is not None:
+		svg_absolutize_image_hrefs(svgdata.getroot(), svg_dir)
+	with open(svgpath, 'wb') as svgfile:
+		svgdata.write(svgfile, encoding='utf-8', xml_declaration=True)
+	if INKSCAPE_SHELL is not None:
+		for args, (_, pdfname) in zip(export_args, exports):
+			run_inkscape_shell_export(args, os.path.abspath(pdfname))
+		return
+	for _, pdfname in exports:
+		if os.path.exists(pdfname):
+			os.unlink(pdfname)
 	with WorkingDirectory(svg_dir):
 		print('cwd for inkscape:', os.getcwd())
 		print('inkscape command:', ' '.join(cmd))
-		subprocess.check_call(cmd, stdin=subprocess.DEVNULL)
+		for line in commands:
+			print('inkscape shell:', line)
+		subprocess.run(cmd, input='\n'.join(commands) + '\n',
+				universal_newlines=True, check=True, env=deterministic_env())
+	for _, pdfname in exports:
+		if not os.path.exists(pdfname):
+			raise Exception('inkscape failed to export ' + pdfname)
 
 def execute_latex(texname, command='pdflatex'):
 	cmd = ['/usr/bin/' + command,
@@ -390,44 +980,99 @@ def execute_latex(texname, command='pdflatex'):
 	       '-halt-on-error',
 	       '-file-line-error',
 	       texname]
-	subprocess.check_call(cmd, stdin=subprocess.DEVNULL)
+	subprocess.check_call(cmd, stdin=subprocess.DEVNULL, env=deterministic_env())
 
-def main():
+def main(argv=None):
 	parser = argparse.ArgumentParser(description='Convert an SVG containing LaTeX elements into a PDF')
 	parser.add_argument('-o', '--output', dest='outpath')
 	parser.add_argument('-k', '--keep', action='store_true')
+	parser.add_argument('-l', '--layers', action='store_true',
+			help='write one PDF per top-level Inkscape layer (OUTPUT-1.pdf, OUTPUT-2.pdf, ...)')
+	parser.add_argument('-j', '--jobs', type=int, default=None,
+			help='number of LaTeX runs to do in parallel (default: use the make jobserver, or 1)')
+	parser.add_argument('-c', '--label-cache', action='store_true',
+			help='typeset each distinct label once, caching the result on disk')
+	parser.add_argument('--label-cache-dir', metavar='DIR', default=None,
+			help='where to keep the label cache (implies --label-cache; '
+			     'default: {})'.format(default_label_cache_dir()))
 	parser.add_argument('inpath', metavar='INPUT')
-	args = parser.parse_args()
+	args = parser.parse_args(argv)
 
 	inpath = os.path.abspath(args.inpath)
 	inname, _ = os.path.splitext(args.inpath)
 	outpath = args.outpath if args.outpath is not None else inname + '.pdf'
+	outname, _ = os.path.splitext(outpath)
 
 	xmldoc = etree.parse(inpath)
 	svgroot = xmldoc.getroot()
 
 	svg_dir = os.path.abspath(os.path.dirname(inpath))
 
+	# the conversion runs in a temporary directory, so a relative cache
+	# path must be resolved against the caller's directory first
+	label_cache = None
+	if args.label_cache or args.label_cache_dir is not None:
+		label_cache = args.label_cache_dir or default_label_cache_dir()
+		label_cache = os.path.abspath(os.path.expanduser(label_cache))
+
+	def deliver(tmp_outpath, outpath):
+		if not update_file(tmp_outpath, outpath, keep_src=args.keep):
+			print('unchanged:', outpath)
+
+	jobs = JobServer(args.jobs)
+
 	def do_svg2pdf(working_dir):
 		with WorkingDirectory(working_dir):
 			texpic = convert_svg_to_texpic(svgroot, svg_dir)
 			generate_pdf_from_svg(xmldoc, 'graphic_only.svg', 'graphic_only.pdf', svg_dir=svg_dir)
+			if label_cache is not None:
+				texpic, = composite_cached_labels([texpic], label_cache, jobs)
 			with open('tex_wrapper.tex', mode='w', encoding='utf-8') as texfile:
 				texpic.emit_standalone(texfile)
 			execute_latex('tex_wrapper.tex')
-		tmp_outpath = os.path.join(working_dir, 'tex_wrapper.pdf')
-		if args.keep:
-			shutil.copy(tmp_outpath, outpath)
-		else:
-			shutil.move(tmp_outpath, outpath)
+		deliver(os.path.join(working_dir, 'tex_wrapper.pdf'), outpath)
 
-	if args.keep:
-		working_dir = '/memtmp/svg2pdf'
-		os.makedirs(working_dir, exist_ok=True)
-		do_svg2pdf(working_dir)
-	else:
-		with tempfile.TemporaryDirectory(prefix='svg2pdf') as working_dir:
+	def do_svg2pdf_layers(working_dir):
+		with WorkingDirectory(working_dir):
+			layers, hidden = convert_svg_layers_to_texpics(svgroot, svg_dir)
+			if not layers:
+				raise Exception('no visible Inkscape layers found in ' + args.inpath)
+			exports = [(layer_id, background) for _, layer_id, background, _ in layers]
+			generate_pdfs_from_svg_ids(xmldoc, 'graphic_only.svg', exports, svg_dir=svg_dir)
+			texpics = [texpic for _, _, _, texpic in layers]
+			if label_cache is not None:
+				texpics = composite_cached_labels(texpics, label_cache, jobs)
+			texnames = []
+			for (i, _, _, _), texpic in zip(layers, texpics):
+				texname = 'layer{}_wrapper.tex'.format(i)
+				with open(texname, mode='w', encoding='utf-8') as texfile:
+					texpic.emit_standalone(texfile)
+				texnames.append(texname)
+			jobs.map(execute_latex, texnames)
+		for i, _, _, _ in layers:
+			deliver(os.path.join(working_dir, 'layer{}_wrapper.pdf'.format(i)),
+					'{}-{}.pdf'.format(outname, i))
+		# don't leave the output of a now hidden layer lying around
+		for i in hidden:
+			stale = '{}-{}.pdf'.format(outname, i)
+			print('layer {} is hidden'.format(i))
+			if os.path.exists(stale):
+				print('removing', stale)
+				os.unlink(stale)
+
+	if args.layers:
+		do_svg2pdf = do_svg2pdf_layers
+
+	try:
+		if args.keep:
+			working_dir = '/memtmp/svg2pdf'
+			os.makedirs(working_dir, exist_ok=True)
 			do_svg2pdf(working_dir)
+		else:
+			with tempfile.TemporaryDirectory(prefix='svg2pdf') as working_dir:
+				do_svg2pdf(working_dir)
+	finally:
+		jobs.close()
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 noet ai:
+
+# Thin client for svg2pdfd.py: takes exactly the same arguments as svg2pdf.py,
+# forwards them to a running daemon and relays its output and exit status.
+# If no daemon is listening, the conversion is run in-process instead.
+#
+# This module must stay cheap to import (standard library only), since
+# avoiding the start-up cost of svg2pdf.py is the whole point.
+
+import socket
+import struct
+import json
+import os
+import sys
+
+FRAME_REQUEST = b'r'
+FRAME_STDOUT = b'o'
+FRAME_STDERR = b'e'
+FRAME_EXIT = b'x'
+
+FRAME_HEADER = struct.Struct('>cI')
+
+def default_socket_path():
+	if 'SVG2PDF_SOCKET' in os.environ:
+		return os.environ['SVG2PDF_SOCKET']
+	run_dir = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+	return os.path.join(run_dir, 'svg2pdfd-{}.sock'.format(os.getuid()))
+
+def send_frame(sock, tag, payload):
+	sock.sendall(FRAME_HEADER.pack(tag, len(payload)) + payload)
+
+def recv_exactly(sock, size):
+	buf = bytearray()
+	while len(buf) < size:
+		chunk = sock.recv(size - len(buf))
+		if not chunk:
+			raise EOFError('svg2pdfd connection closed unexpectedly')
+		buf.extend(chunk)
+	return bytes(buf)
+
+def recv_frame(sock):
+	tag, size = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+	return tag, recv_exactly(sock, size)
+
+def run_remote(sock, argv):
+	request = {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+	send_frame(sock, FRAME_REQUEST, json.dumps(request).encode('utf-8'))
+	stdout = sys.stdout.buffer
+	stderr = sys.stderr.buffer
+	while True:
+		tag, payload = recv_frame(sock)
+		if tag == FRAME_STDOUT:
+			stdout.write(payload)
+			stdout.flush()
+		elif tag == FRAME_STDERR:
+			stderr.write(payload)
+			stderr.flush()
+		elif tag == FRAME_EXIT:
+			return struct.unpack('>i', payload)[0]
+		else:
+			raise Exception('unexpected frame from svg2pdfd ({!r})'.format(tag))
+
+def main(argv=None):
+	if argv is None:
+		argv = sys.argv[1:]
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(default_socket_path())
+	except OSError:
+		sock.close()
+		import svg2pdf
+		svg2pdf.main(argv)
+		return 0
+	with sock:
+		return run_remote(sock, argv)
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 noet ai:
+
+# Resident svg2pdf conversion daemon.
+#
+# Keeps the interpreter, lxml, the svg2pdf module and an `inkscape --shell`
+# process loaded and listens on a Unix socket for requests from svg2pdfc.py.
+# Each request is handled in a forked child, so the working directory,
+# environment and file descriptors of one conversion can't leak into the
+# next one, while the start-up work done here is shared by all of them.
+
+import socketserver
+import threading
+import traceback
+import argparse
+import signal
+import struct
+import json
+import os
+import sys
+
+import svg2pdf
+import svg2pdfc
+from svg2pdfc import FRAME_REQUEST, FRAME_STDOUT, FRAME_STDERR, FRAME_EXIT
+
+class OutputPump(threading.Thread):
+	# copies everything written to a file descriptor into frames on the client socket
+	def __init__(self, sock, lock, tag, fd):
+		super().__init__(daemon=True)
+		self._sock = sock
+		self._lock = lock
+		self._tag = tag
+		self._fd = fd
+
+	def run(self):
+		while True:
+			data = os.read(self._fd, 65536)
+			if not data:
+				break
+			with self._lock:
+				svg2pdfc.send_frame(self._sock, self._tag, data)
+		os.close(self._fd)
+
+def run_request(request):
+	os.chdir(request['cwd'])
+	os.environ.clear()
+	os.environ.update(request['env'])
+	# make's jobserver pipe belongs to the client, not to us
+	if 'MAKEFLAGS' in os.environ:
+		os.environ['MAKEFLAGS'] = svg2pdf.strip_jobserver_fds(os.environ['MAKEFLAGS'])
+	sys.argv = ['svg2pdf.py'] + request['argv']
+	try:
+		svg2pdf.main(request['argv'])
+	except SystemExit as e:
+		if e.code is None:
+			return 0
+		if isinstance(e.code, int):
+			return e.code
+		print(e.code, file=sys.stderr)
+		return 1
+	except Exception:
+		traceback.print_exc()
+		return 1
+	return 0
+
+class ConversionHandler(socketserver.BaseRequestHandler):
+	def handle(self):
+		tag, payload = svg2pdfc.recv_frame(self.request)
+		if tag != FRAME_REQUEST:
+			return
+		request = json.loads(payload.decode('utf-8'))
+
+		# route our own output and that of inkscape/pdflatex back to the client
+		lock = threading.Lock()
+		pumps = []
+		for tag, fd in ((FRAME_STDOUT, 1), (FRAME_STDERR, 2)):
+			rd, wr = os.pipe()
+			os.dup2(wr, fd)
+			os.close(wr)
+			pump = OutputPump(self.request, lock, tag, rd)
+			pump.start()
+			pumps.append(pump)
+
+		code = run_request(request)
+
+		sys.stdout.flush()
+		sys.stderr.flush()
+		devnull = os.open(os.devnull, os.O_WRONLY)
+		os.dup2(devnull, 1)
+		os.dup2(devnull, 2)
+		os.close(devnull)
+		for pump in pumps:
+			pump.join()
+		with lock:
+			svg2pdfc.send_frame(self.request, FRAME_EXIT, struct.pack('>i', code))
+
+class ConversionServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+	def service_actions(self):
+		super().service_actions()
+		# bring the shared Inkscape back if it died
+		if not svg2pdf.INKSCAPE_SHELL.alive():
+			print('restarting inkscape shell')
+			sys.stdout.flush()
+			svg2pdf.INKSCAPE_SHELL.start()
+
+def main():
+	parser = argparse.ArgumentParser(description='Serve svg2pdf conversions over a Unix socket')
+	parser.add_argument('-s', '--socket', dest='socket_path', default=svg2pdfc.default_socket_path())
+	args = parser.parse_args()
+
+	if os.path.exists(args.socket_path):
+		os.unlink(args.socket_path)
+
+	# requests run with whatever cwd and environment the client sends, so
+	# the socket must never be reachable by other users, not even briefly
+	old_umask = os.umask(0o177)
+	try:
+		server = ConversionServer(args.socket_path, ConversionHandler)
+	finally:
+		os.umask(old_umask)
+
+	# started before any request is forked, so all of them share it
+	svg2pdf.INKSCAPE_SHELL = svg2pdf.InkscapeShell()
+	svg2pdf.INKSCAPE_SHELL.start()
+
+	# clean up (socket, inkscape) on kill as well as on ^C
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+	with server:
+		print('svg2pdfd listening on', args.socket_path)
+		sys.stdout.flush()
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			os.unlink(args.socket_path)
+			svg2pdf.INKSCAPE_SHELL.close()
+
+if __name__ == '__main__':
+	main()